@@ -7,7 +7,28 @@ and displays incoming messages in a text area.
 # Import necessary libraries
 from tkinter import Frame, Tk, Text, Entry, Button, END, WORD, BOTTOM, TOP, LEFT, RIGHT, X, BOTH
 import asyncio as aio
+import collections
+import select
 import socket as soc
+import struct
+import threading
+
+# Initial size of the receive buffer, the most bytes read from the server socket at once
+RECV_SIZE = 16384
+
+# Messages sent to and received from the server are preceded by their length
+LENGTH_PREFIX = struct.Struct("!I")
+
+# The largest message the server accepts, it disconnects clients that send more
+MAX_MESSAGE_SIZE = 1024 * 1024
+# The largest message accepted from the server, which also holds the sender's address
+MAX_RECEIVE_SIZE = MAX_MESSAGE_SIZE + 256
+
+# Seconds the Tk thread waits for the server socket to take a message
+SEND_TIMEOUT = 5
+
+# Interval in milliseconds between two updates of the text area with incoming messages
+FLUSH_INTERVAL = 33
 
 class Window(Tk):
     """
@@ -26,56 +47,92 @@ class Window(Tk):
         self.geometry("600x500+200+200")
         self.protocol("WM_DELETE_WINDOW", self.destroy)
         self.running = aio.Event()
+        # Reusable buffer that outgoing messages are encoded into
+        self._send_buf = bytearray(256)
+        # Incoming messages waiting to be inserted into the text area
+        self._in_queue: collections.deque[str] = collections.deque()
+        # Reusable receive buffer, and the number of bytes of an incomplete message in it
+        self._rbuf = bytearray(RECV_SIZE)
+        self._rmv = memoryview(self._rbuf)
+        self._rend = 0
 
         # Connect to the server socket
         self.connect()
 
         # Create widgets for the GUI
         self.make_widgets()
+        # Bind the method used every time a message is displayed
+        self._insert = self.msg_display.insert
+        self.after(FLUSH_INTERVAL, self._flush_in)
 
-        # Initialize the asyncio event loop and start reading messages
+        # Run the asyncio event loop on a background thread and start reading messages,
+        # so incoming messages are handled as soon as they arrive instead of on a Tk timer
         self.loop = aio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.loop_thread.start()
         self.running_task = aio.run_coroutine_threadsafe(self.read(), self.loop)
-        self.run_loop()
 
     def send_message(self):
         """
         Sends a message from the message box to the server socket.
         """
-        # Get the message from the message box, append an EOF marker, and send it to the server
+        # Get the message from the message box, prefix it with its length, and send it to the server
         message = self.msg_box.get()
 
         # Check if the message is not empty before sending
         if message != "":
             try:
-                # Append EOF marker to the message and send it
-                msg = message + "<EOF>"
-                print(f"Sending message: {msg}")
+                # Write the length followed by the encoded message into the send buffer,
+                # in place since clearing a bytearray gives its memory back
+                print(f"Sending message: {message}")
+                payload = message.encode('utf-8')
+                if len(payload) > MAX_MESSAGE_SIZE:
+                    # The server would drop the connection, keep the message in the box instead
+                    self._insert(END, f"Message not sent, it is larger than {MAX_MESSAGE_SIZE} bytes\n")
+                    return
+                size = LENGTH_PREFIX.size + len(payload)
+                buf = self._send_buf
+                if len(buf) < size:
+                    buf.extend(bytes(size - len(buf)))
+                LENGTH_PREFIX.pack_into(buf, 0, len(payload))
+                buf[LENGTH_PREFIX.size:size] = payload
                 # Send the message to the server socket
-                print(self.client_socket.send(msg.encode('utf-8')))
+                with memoryview(buf)[:size] as view:
+                    self._send_all(view)
                 # Clear the message box and update the display area
                 self.msg_box.delete(0, END)
-                self.msg_display.insert(END, f"You: {message}\n")
+                self._insert(END, f"You: {message}\n")
 
             # pylint: disable=broad-except
             except Exception as e:
                 # Handle any exceptions that occur during sending
                 print(f"Error sending message: {e}")
 
-    def run_loop(self):
-        """
-        Runs the asyncio event loop to handle incoming messages.
-        This method is called periodically to ensure the event loop is running.
+    def _send_all(self, view):
         """
-        try:
-            # Run the asyncio event loop for a short duration to process incoming messages
-            self.loop.run_until_complete(aio.sleep(0))
-        # pylint: disable=broad-except
-        except Exception:
-            pass
+        Sends all of a message to the server socket, waiting up to SEND_TIMEOUT
+        for it to become writable whenever it is full.
+        sendall cannot be used since the socket is non-blocking, it would give up
+        part way and the server would read the rest of the message as a length.
 
-        # Schedule the next run of the event loop
-        self.after(10, self.run_loop)
+        args:
+            view: A memoryview of the message, including its length.
+
+        Returns:
+            None
+        """
+        sent = 0
+        while sent < len(view):
+            try:
+                sent += self.client_socket.send(view[sent:])
+            except BlockingIOError:
+                _, writable, _ = select.select([], [self.client_socket], [], SEND_TIMEOUT)
+                if not writable:
+                    if sent:
+                        # Part of the message is out, the stream can no longer be
+                        # understood by the server, so end the connection
+                        self.client_socket.shutdown(soc.SHUT_RDWR)
+                    raise TimeoutError("timed out sending the message") from None
 
     def connect(self):
         """
@@ -84,6 +141,8 @@ class Window(Tk):
 
         self.client_socket = soc.socket(soc.AF_INET, soc.SOCK_STREAM)
         self.client_socket.connect((soc.gethostbyname(soc.gethostname()), 8080))
+        # Send messages immediately instead of waiting for Nagle's algorithm
+        self.client_socket.setsockopt(soc.IPPROTO_TCP, soc.TCP_NODELAY, 1)
         self.client_socket.setblocking(False)
         print("Connected to server")
 
@@ -95,7 +154,8 @@ class Window(Tk):
         """
 
         print("Window closed")
-        self.running.set()
+        # The event belongs to the asyncio loop, so set it from the loop's thread
+        self.loop.call_soon_threadsafe(self.running.set)
         self.client_socket.close()
         super().destroy()
 
@@ -110,39 +170,77 @@ class Window(Tk):
             # the running task is cancelled
             if self.running_task:
                 self.running_task.cancel()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop_thread.join()
             self.loop.close()
 
     async def read(self):
         """
         Asynchronously reads messages from the server socket 
         and displays them in the text area.
-        This method runs in a loop until the connection is closed 
+        This method runs in a loop on the asyncio thread until the connection is closed 
         or an error occurs.
         """
 
         print("Starting to read messages...")
+        loop = aio.get_running_loop()
         # Run until the running event is set
         while not self.running.is_set():
             try:
-                # Attempt to read a message from the server socket
-                msg = self.client_socket.recv(1024)
+                # Make room for at least one more byte, and once the length of the
+                # incomplete message is known, for the whole message
+                needed = self._rend + 1
+                if self._rend >= LENGTH_PREFIX.size:
+                    length = LENGTH_PREFIX.unpack_from(self._rbuf)[0]
+                    if length > MAX_RECEIVE_SIZE:
+                        # Whatever follows can no longer be trusted, end the connection
+                        print(f"Message of {length} bytes from the server is too large")
+                        self.client_socket.shutdown(soc.SHUT_RDWR)
+                        self.running.set()
+                        break
+                    needed = LENGTH_PREFIX.size + length
+
+                # Grow the receive buffer if the message does not fit. A new buffer
+                # is made since the existing one cannot be resized while viewed
+                if needed > len(self._rbuf):
+                    self._rmv.release()
+                    size = max(needed, 2 * len(self._rbuf))
+                    self._rbuf = self._rbuf + bytes(size - len(self._rbuf))
+                    self._rmv = memoryview(self._rbuf)
+
+                # Wait until the server socket is readable and
+                # receive data directly into the free part of the buffer
+                n = await loop.sock_recv_into(self.client_socket, self._rmv[self._rend:])
 
-                # If a message is received, decode it and insert it into the text area
-                if msg != b'':
-                    self.msg_display.insert(END, msg.decode('utf-8').replace('<EOF>', '') + '\n')
+                # If data is received, decode every complete message and queue it
+                # for the Tk thread to insert it into the text area
+                if n != 0:
+                    end = self._rend + n
+                    start = 0
+                    while end - start >= LENGTH_PREFIX.size:
+                        msg_start = start + LENGTH_PREFIX.size
+                        msg_end = msg_start + LENGTH_PREFIX.unpack_from(self._rbuf, start)[0]
+                        if msg_end > end:
+                            break
+                        text = str(self._rmv[msg_start:msg_end], 'utf-8', 'replace')
+                        self._in_queue.append(text + '\n')
+                        start = msg_end
+
+                    # Keep the start of an incomplete message for the next read
+                    self._rend = end - start
+                    if start:
+                        self._rbuf[:self._rend] = self._rbuf[start:end]
                 # If server closes the connection, break the loop
                 else:
                     print("Connection closed by server")
                     self.running.set()
                     break
-            except BlockingIOError:
-                # Handle the case where no data is available to read
-                await aio.sleep(0)
             except OSError as e:
-                # Handle socket errors, specifically connection reset by peer
-                if getattr(e, 'errno', None) == 10054:
-                    self.running.set()
-                    break
+                # Handle socket errors, such as connection reset by peer,
+                # retrying would only fail again on the same socket
+                print(f"Socket error while reading: {e}")
+                self.running.set()
+                break
             except aio.CancelledError:
                 # Handle cancellation of the coroutine
                 break
@@ -150,9 +248,20 @@ class Window(Tk):
             except Exception as e:
                 # Handle any other exceptions that may occur
                 print(f"Error reading message: {e}")
-            finally:
-                # Ensure the event loop yields control to allow other tasks to run
-                await aio.sleep(0)
+
+    def _flush_in(self):
+        """
+        Inserts all queued incoming messages into the text area at once,
+        so the text area is redrawn at most once per FLUSH_INTERVAL.
+        This method reschedules itself on the Tk thread.
+        """
+        # Only take the messages queued so far, read may keep appending meanwhile
+        count = len(self._in_queue)
+        if count:
+            popleft = self._in_queue.popleft
+            self._insert(END, "".join([popleft() for _ in range(count)]))
+
+        self.after(FLUSH_INTERVAL, self._flush_in)
 
     def _do_nothing(self, _event):
         """
@@ -5,12 +5,14 @@ This script is was meant to test the client side logic to connect to the server
 # Import necessary modules
 import socket as soc
 import asyncio as aio
+import struct
 
 # Initialize the client socket
 client = soc.socket(soc.AF_INET, soc.SOCK_STREAM)
 
 # Connect to the server
 client.connect((soc.gethostbyname(soc.gethostname()), 8080))
+client.setsockopt(soc.IPPROTO_TCP, soc.TCP_NODELAY, 1)
 client.setblocking(False)
 
 async def read_data():
@@ -19,9 +21,13 @@ async def read_data():
     It attempts to read data from the socket and prints it to the console.
     """
     try:
-        # Attempt to read data from the client socket
-        data = client.recv(1024)
-        print(f"Received: {data.decode()}")
+        # Attempt to read data from the client socket,
+        # each message in it is preceded by its length
+        data = client.recv(16384)
+        while len(data) >= 4:
+            length = struct.unpack_from("!I", data)[0]
+            print(f"Received: {data[4:4 + length].decode()}")
+            data = data[4 + length:]
     except BlockingIOError:
         # If the socket is not ready to read data, we simply return
         return
@@ -45,8 +51,9 @@ async def main():
     # The loop will run until 10 messages are sent or an error occurs
     while i < 10:
         try:
-            # Send a message to the server with a counter and an EOF marker
-            client.sendall(f"Message no {i}<EOF>".encode())
+            # Send a message to the server with a counter, preceded by its length
+            payload = f"Message no {i}".encode()
+            client.sendall(struct.pack("!I", len(payload)) + payload)
 
             # Create a task to read data from the server asynchronously
             aio.create_task(read_data())
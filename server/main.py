@@ -8,71 +8,405 @@ non-blocking sockets to handle multiple clients concurrently.
 
 # import necessary modules
 import asyncio as aio
+import collections
+import os
 import socket as soc
+import struct
+import sys
 from redis.asyncio import Redis
 
-# Initilize the server socket and a list to keep track of connected clients
+# Initilize the server socket and a set to keep track of connected clients
 server = soc.socket(soc.AF_INET, soc.SOCK_STREAM)
-clients: list[soc.socket] = []
+clients: set[soc.socket] = set()
+# The "<address>: " header prepended to each client's messages, cached on connection
+peer_header: dict[soc.socket, bytes] = {}
+# Bytes a client's socket could not take yet, sent once the socket is writable again
+pending_writes: dict[soc.socket, bytearray] = {}
+# Set whenever a client's deferred bytes drain below BACKLOG_HIGH_WATER
+backlog_drained = aio.Event()
 r = Redis(host="redis", port=6379)
 
-async def read_all(client_socket: soc.socket) -> tuple[bytes, bool]:
+# Initial size of the per-client receive buffer
+RECV_BUFFER_SIZE = 65536
+
+# Messages from and to clients are preceded by their length, see read_all
+LENGTH_PREFIX = struct.Struct("!I")
+MAX_MESSAGE_SIZE = 1024 * 1024
+
+# Bytes a client's task handles before letting the other tasks run, see handle_client
+YIELD_BYTES = 65536
+
+# The most bytes kept for a client whose socket is full from earlier broadcasts,
+# see send_parts
+MAX_BACKLOG_SIZE = 4 * 1024 * 1024
+
+# Senders stop reading while a client has more bytes than this waiting,
+# and clients that do not get below it within the timeout are disconnected, see wait_for_backlogs
+BACKLOG_HIGH_WATER = MAX_BACKLOG_SIZE // 2
+BACKLOG_WAIT_TIMEOUT = 5
+
+# The most bytes a batch of buffered messages is sent as in one broadcast, see handle_client
+MAX_BATCH_SIZE = 256 * 1024
+
+# Sizing of the send buffer pool. broadcast is synchronous and gives its buffer back
+# before returning, so only one buffer is in use at a time
+POOL_SIZE = 2
+SEND_BUFFER_SIZE = 16384
+
+class BufPool:
+    """
+    A pool of reusable bytearrays used to build outgoing messages
+    without allocating a new buffer for every message.
+    """
+
+    def __init__(self, n: int, sz: int):
+        """
+        Pre-allocates the buffers of the pool.
+
+        Args:
+            n (int): The number of buffers to pre-allocate.
+            sz (int): The initial size of each buffer.
+        """
+        self.sz = sz
+        self.q: collections.deque[bytearray] = collections.deque(bytearray(sz) for _ in range(n))
+
+    def acquire(self) -> bytearray:
+        """
+        Takes a buffer from the pool, or allocates a new one if the pool is empty.
+
+        Returns:
+            bytearray: The buffer, its contents are unspecified.
+        """
+        try:
+            return self.q.pop()
+        except IndexError:
+            return bytearray(self.sz)
+
+    def release(self, b: bytearray) -> None:
+        """
+        Returns a buffer to the pool so it can be reused.
+        A buffer that was grown past the pool's buffer size is dropped instead,
+        so one large message does not keep its memory in use for good.
+
+        Args:
+            b (bytearray): The buffer previously returned by acquire.
+        """
+        if len(b) <= self.sz:
+            self.q.append(b)
+
+# sendmsg is not available on every platform, Windows sockets do not have it
+HAS_SENDMSG = hasattr(soc.socket, "sendmsg")
+
+# The most buffers a single sendmsg call accepts.
+# sysconf gives -1 when there is no fixed limit, so fall back to a safe value then
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = -1
+if IOV_MAX <= 0:
+    IOV_MAX = 1024
+
+# Broadcasts only join messages into pooled buffers when sendmsg is not available
+pool = None if HAS_SENDMSG else BufPool(POOL_SIZE, SEND_BUFFER_SIZE)
+
+async def read_all(client_socket: soc.socket, state: dict) -> tuple[memoryview, bool]:
     """ 
-    A function to read all the messages from a client socket 
-    until it receives a message ending with <EOF>.
+    A function to read the next message from a client socket.
+    Every message from a client starts with its length as a 4 byte
+    big-endian unsigned integer, followed by that many bytes.
 
     Args:
         client_socket (soc.socket): The socket object for the client connection.
+        state (dict): The per-connection receive state, holding the reusable
+        receive buffer under "buf", and the start and end of the buffered bytes
+        that were not returned yet under "start" and "end".
     
     Returns:
-        tuple[bytes, bool]: A tuple containing the received data and a boolean indicating 
+        tuple[memoryview, bool]: A tuple containing the received data and a boolean indicating 
         if the client is still connected.
         if the client is still connected, 
         the boolean will be True, otherwise it will be False.
-        data will be the bytes received from the client or 
-        None if the data to be read is not ready.
+        data will be a view of the message received from the client, without its length,
+        or None if the client disconnected or an error occurred.
+        The view is only valid until the next call to read_all for the same client.
     """
 
-    # initialize an empty bytes object to store the received data
-    data = b""
+    loop = aio.get_running_loop()
+
+    # A previous read may have left a complete message in the buffer
+    data = next_message(state)
+    if data is not None:
+        return data, True
+
+    # Everything before start was already returned, move the rest to the front.
+    # The views handed out earlier are no longer used at this point
+    buf: bytearray = state["buf"]
+    start: int = state["start"]
+    end: int = state["end"] - start
+    if start:
+        buf[:end] = buf[start:start + end]
+        state["start"] = 0
+        state["end"] = end
 
     # Use a loop to continuously read data from the client socket
-    # until it receives a message ending with <EOF> or the client disconnects or an error occurs
+    # until it holds a complete message or the client disconnects or an error occurs
     while True:
         try:
-            # Try to receive data from the client socket
-            chunk = client_socket.recv(1024)
+            # Make room for at least one more byte, and once the length is known,
+            # for the whole message
+            needed = end + 1
+            if end >= LENGTH_PREFIX.size:
+                length = LENGTH_PREFIX.unpack_from(buf)[0]
+                if length > MAX_MESSAGE_SIZE:
+                    print(f"Message of {length} bytes is too large")
+                    return None, False
+                needed = LENGTH_PREFIX.size + length
+
+            # Grow the buffer only when the message does not fit. A new buffer is
+            # made instead of extending in place, as the event loop may still
+            # hold a view of the old one from the previous receive
+            if needed > len(buf):
+                buf = state["buf"] = buf + bytes(max(needed, 2 * len(buf)) - len(buf))
+
+            # Wait until the socket is readable and receive data
+            # directly into the free part of the buffer
+            n = await loop.sock_recv_into(client_socket, memoryview(buf)[end:])
 
-            # Append the received chunk to the data
-            data += chunk
+            # If nothing was received, it means the client has disconnected,
+            # any incomplete message is dropped and we return False to indicate disconnection
+            if n == 0:
+                state["end"] = 0
+                return None, False
 
-            # If the chunk is empty, it means the client has disconnected
-            # and we return the data received so far and False to indicate disconnection
-            if chunk == b'':
-                return data, False
+            end += n
+            state["end"] = end
 
-            # If the received data ends with <EOF>,
-            #  return the data and True to indicate the client is still connected
-            if data.endswith(b'<EOF>'):
+            data = next_message(state)
+            if data is not None:
                 return data, True
-        except BlockingIOError:
-            # If the socket is not ready to read data, return None and True
-            # to indicate that the client is still connected but no data is available at the moment
-            return None, True
         # pylint: disable=broad-except
         except Exception as e:
             # Handle any other exceptions that may occur during reading
             print(f"Error while reading messages: {e}")
             return None, False
 
-async def broadcast(message: bytes, sender: soc.socket) -> None:
+def next_message(state: dict) -> memoryview | None:
+    """
+    Takes the next complete message out of the receive buffer without reading from the socket.
+    The buffer is not compacted here, so views of earlier messages stay valid.
+
+    Args:
+        state (dict): The per-connection receive state, see read_all.
+
+    Returns:
+        memoryview | None: A view of the message without its length,
+        or None if the buffer does not hold a complete message.
+    """
+    buf: bytearray = state["buf"]
+    start: int = state["start"]
+    if state["end"] - start < LENGTH_PREFIX.size:
+        return None
+
+    msg_start = start + LENGTH_PREFIX.size
+    msg_end = msg_start + LENGTH_PREFIX.unpack_from(buf, start)[0]
+    if msg_end > state["end"]:
+        return None
+
+    state["start"] = msg_end
+    return memoryview(buf)[msg_start:msg_end]
+
+def peer_name(client: soc.socket) -> str:
+    """
+    Returns the address of a client for log messages,
+    without calling getpeername on a socket that may already be closed.
+
+    Args:
+        client (soc.socket): The socket of the client.
+
+    Returns:
+        str: The client's address as it was when it connected.
+    """
+    return peer_header[client][:-2].decode()
+
+def send_parts(client: soc.socket, parts: list, size: int) -> bool:
+    """
+    Sends a message made of several buffers to a client, in a single system call
+    whenever the socket can take all of it and there are no more than IOV_MAX buffers.
+    Whatever the socket cannot take right away is deferred, see defer_write.
+    An OSError from the socket other than a connection error is treated
+    the same way, the deferred bytes are then sent without sendmsg.
+
+    Args:
+        client (soc.socket): The socket of the client to send the message to.
+        parts (list): The bytes-like buffers that make up the message, in order.
+        A single buffer if sendmsg is not available.
+        size (int): The total length of the buffers in parts.
+
+    Returns:
+        bool: False if more than MAX_BACKLOG_SIZE bytes from earlier calls are still
+        waiting for the client, in which case nothing more was queued
+        and the client should be disconnected.
+        The bytes of this call alone never get a client disconnected.
+    """
+    backlog = pending_writes.get(client)
+    if backlog is not None:
+        # Earlier messages are still waiting for this client, queue behind them
+        # unless the client is too far behind
+        if len(backlog) > MAX_BACKLOG_SIZE:
+            return False
+        for part in parts:
+            backlog += part
+        return True
+
+    if not HAS_SENDMSG:
+        groups = [parts]
+    else:
+        # sendmsg fails with "Message too long" when given more than IOV_MAX buffers
+        groups = [parts[i:i + IOV_MAX] for i in range(0, len(parts), IOV_MAX)]
+
+    sent = 0
+    for group in groups:
+        group_size = size if len(groups) == 1 else sum(len(part) for part in group)
+        try:
+            group_sent = client.sendmsg(group) if HAS_SENDMSG else client.send(group[0])
+        except BlockingIOError:
+            group_sent = 0
+        except ConnectionError:
+            raise
+        except OSError as e:
+            print(f"Error while sending to {peer_name(client)}, deferring: {e}")
+            group_sent = 0
+
+        sent += group_sent
+        if group_sent < group_size:
+            defer_write(client, parts, sent)
+            break
+
+    return True
+
+def defer_write(client: soc.socket, parts: list, sent: int) -> None:
+    """
+    Keeps the unsent rest of a message for a client whose socket is full,
+    and lets the event loop call flush_pending once the socket is writable again.
+    Further messages are only queued behind it while the kept bytes stay within
+    MAX_BACKLOG_SIZE, so a client that stops reading cannot make the server
+    hold on to every broadcast, see send_parts.
+
+    Args:
+        client (soc.socket): The socket of the client.
+        parts (list): The bytes-like buffers that make up the message, in order.
+        sent (int): The number of bytes of the message that were already sent.
+
+    Returns:
+        None
+    """
+    # The parts may be views of buffers that get reused, so keep a copy
+    pending_writes[client] = bytearray(memoryview(b"".join(parts))[sent:])
+    aio.get_running_loop().add_writer(client, flush_pending, client)
+
+def flush_pending(client: soc.socket) -> None:
+    """
+    Called by the event loop when a client with deferred bytes is writable,
+    sends as much of them as the socket takes.
+    The deferred bytes never exceed MAX_BACKLOG_SIZE by more than one broadcast,
+    see send_parts.
+
+    Args:
+        client (soc.socket): The socket of the client.
+
+    Returns:
+        None
+    """
+    backlog = pending_writes[client]
+    try:
+        sent = client.send(backlog)
+    except BlockingIOError:
+        return
+    # pylint: disable=broad-except
+    except Exception as e:
+        print(f"Error while broadCasting {peer_name(client)}: {e}")
+        disconnect(client)
+        return
+
+    del backlog[:sent]
+    if len(backlog) <= BACKLOG_HIGH_WATER:
+        backlog_drained.set()
+    if not backlog:
+        drop_pending(client)
+
+def drop_pending(client: soc.socket) -> None:
+    """
+    Forgets the deferred bytes of a client and stops waiting for its socket to be writable.
+
+    Args:
+        client (soc.socket): The socket of the client.
+
+    Returns:
+        None
+    """
+    if pending_writes.pop(client, None) is not None:
+        aio.get_running_loop().remove_writer(client)
+        backlog_drained.set()
+
+async def wait_for_backlogs() -> None:
+    """
+    Waits while any client has more than BACKLOG_HIGH_WATER deferred bytes,
+    so a sender cannot outpace the clients that receive its messages.
+    Clients still above it after BACKLOG_WAIT_TIMEOUT are disconnected.
+
+    Returns:
+        None
+    """
+    loop = aio.get_running_loop()
+    deadline = loop.time() + BACKLOG_WAIT_TIMEOUT
+    while True:
+        behind = [client for client, backlog in pending_writes.items()
+                  if len(backlog) > BACKLOG_HIGH_WATER]
+        if not behind:
+            return
+
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            for client in behind:
+                print(f"Client {peer_name(client)} is not reading, disconnecting.")
+                disconnect(client)
+            return
+
+        backlog_drained.clear()
+        try:
+            await aio.wait_for(backlog_drained.wait(), remaining)
+        except TimeoutError:
+            pass
+
+def disconnect(client: soc.socket) -> None:
     """
-    a function to handle the task of broadcasting a message 
+    Stops sending to a client and shuts its socket down,
+    so its handle_client task sees the disconnection and cleans up.
+
+    Args:
+        client (soc.socket): The socket of the client.
+
+    Returns:
+        None
+    """
+    drop_pending(client)
+    clients.discard(client)
+    try:
+        client.shutdown(soc.SHUT_RDWR)
+    except OSError:
+        # The socket is already closed or disconnected
+        pass
+
+def broadcast(messages: list[bytes], sender: soc.socket) -> None:
+    """
+    a function to handle the task of broadcasting messages 
     to all connected clients except the sender.
+    This never waits on a socket, so it is called directly rather than as a task.
     
     Args:
-        message (bytes): The message to broadcast.
-        sender (soc.socket): The socket of the client that sent the message.
+        messages (list[bytes]): The messages to broadcast.
+        Any bytes-like objects work, they are only read during the call.
+        sender (soc.socket): The socket of the client that sent the messages.
 
     Returns:
         None
@@ -81,30 +415,66 @@ async def broadcast(message: bytes, sender: soc.socket) -> None:
     if len(clients) < 2:
         return
 
-    # Prepend the sender's address to the message and encode it
-    message = str(sender.getpeername()).encode() + b": " + message
+    # Every message of the batch is sent as its length,
+    # followed by the sender's address and the message itself
+    header = peer_header[sender]
+    size = (LENGTH_PREFIX.size + len(header)) * len(messages) + sum(len(message) for message in messages)
 
-    # Iterate through the list of clients and send the message to each one
-    for client in clients[:]:
-        try:
-            # Skip the sender to avoid sending the message back to the client that sent it
-            if client == sender:
-                continue
-
-            # Send the message to the client
-            client.sendall(message)
-        except BrokenPipeError:
-            # Handle the case where the client has disconnected
-            print(f"Client {client.getpeername()} disconnected.")
-            clients.remove(client)
-        except BlockingIOError:
-            # If the socket is not ready to send data, yield control to the event loop
-            await aio.sleep(0)
-        # pylint: disable=broad-except
-        except Exception as e:
-            # Handle any other exceptions that may occur during broadcasting
-            print(f"Error while broadCasting {client.getpeername()}: {e}")
-            clients.remove(client)
+    buf = None
+    if HAS_SENDMSG:
+        # Let the kernel gather the headers and the messages, so they are never joined
+        parts = []
+        for message in messages:
+            parts.append(LENGTH_PREFIX.pack(len(header) + len(message)))
+            parts.append(header)
+            parts.append(message)
+    else:
+        # Join the headers and the messages once for all clients, in a pooled buffer.
+        # The buffer is written in place rather than cleared, since clearing a
+        # bytearray gives its memory back and would defeat the pooling
+        buf = pool.acquire()
+        if len(buf) < size:
+            buf.extend(bytes(size - len(buf)))
+        pos = 0
+        for message in messages:
+            LENGTH_PREFIX.pack_into(buf, pos, len(header) + len(message))
+            pos += LENGTH_PREFIX.size
+            buf[pos:pos + len(header)] = header
+            pos += len(header)
+            buf[pos:pos + len(message)] = message
+            pos += len(message)
+        view = memoryview(buf)[:size]
+        parts = [view]
+
+    # Clients that fail are collected and disconnected after the loop
+    dead: list[soc.socket] = []
+    try:
+        # Iterate through the clients and send the messages to each one
+        for client in clients:
+            try:
+                # Skip the sender to avoid sending the messages back to the client that sent them
+                if client == sender:
+                    continue
+
+                # Send the messages to the client, a client that is too far behind is dropped
+                if not send_parts(client, parts, size):
+                    print(f"Client {peer_name(client)} is not reading, disconnecting.")
+                    dead.append(client)
+            except BrokenPipeError:
+                # Handle the case where the client has disconnected
+                print(f"Client {peer_name(client)} disconnected.")
+                dead.append(client)
+            # pylint: disable=broad-except
+            except Exception as e:
+                # Handle any other exceptions that may occur during broadcasting
+                print(f"Error while broadCasting {peer_name(client)}: {e}")
+                dead.append(client)
+    finally:
+        for client in dead:
+            disconnect(client)
+        if buf is not None:
+            view.release()
+            pool.release(buf)
 
 async def handle_client(client_socket: soc.socket, add: tuple) -> None:
     """
@@ -118,29 +488,56 @@ async def handle_client(client_socket: soc.socket, add: tuple) -> None:
         None
     """
     client_socket.setblocking(False)
-    clients.append(client_socket)
-    await broadcast(f"{add[0]}:{add[1]} has connected<EOF>".encode(), client_socket)
+    clients.add(client_socket)
+    peer_header[client_socket] = str(add).encode() + b": "
+    # Reusable receive buffer for this connection, see read_all
+    state = {"buf": bytearray(RECV_BUFFER_SIZE), "start": 0, "end": 0}
+    broadcast([f"{add[0]}:{add[1]} has connected".encode()], client_socket)
     await r.hset(f"connections:{add[0]}:{add[1]}", mapping={
         "address": str(add[0]),
         "port": str(add[1])
     })
     connected = True
+    # Bytes handled since this task last yielded to the event loop
+    handled = 0
     while connected:
         try:
-            data, conn = await read_all(client_socket)
+            data, conn = await read_all(client_socket, state)
             if not conn:
                 connected = False
-            if data :
-                print(f"Received from {add}: {data}")
-                aio.create_task(broadcast(data, client_socket))
-            await aio.sleep(0)  # Yield control to the event loop
+            if data is not None:
+                # Send the messages that are already complete in the buffer in one batch,
+                # up to MAX_BATCH_SIZE bytes once the header and length are added.
+                # The rest stay buffered for the next batch
+                overhead = LENGTH_PREFIX.size + len(peer_header[client_socket])
+                batch = [data]
+                batch_size = overhead + len(data)
+                while batch_size < MAX_BATCH_SIZE and (data := next_message(state)) is not None:
+                    batch.append(data)
+                    batch_size += overhead + len(data)
+                handled += LENGTH_PREFIX.size * len(batch) + sum(len(message) for message in batch)
+                batch = [message for message in batch if message]
+                if batch:
+                    print(f"Received {len(batch)} message(s) from {add}")
+                    broadcast(batch, client_socket)
+                    # Stop reading from this client while others are far behind on its messages
+                    if pending_writes:
+                        await wait_for_backlogs()
+
+            # read_all does not suspend while data is waiting on the socket, so a client
+            # that keeps it full would never let the other tasks run without this
+            if handled >= YIELD_BYTES:
+                handled = 0
+                await aio.sleep(0)
         # pylint:  disable=broad-except
         except Exception as e:
             print(f"error while handling client: {e}")
             break
     print(f"client {add} disconnected.")
     print(f"length of clients: {len(clients)}")
-    clients.remove(client_socket)
+    clients.discard(client_socket)
+    drop_pending(client_socket)
+    peer_header.pop(client_socket, None)
     await r.delete(f"connections:{add[0]}:{add[1]}")
     client_socket.close()
 
@@ -159,18 +556,18 @@ async def main() -> None:
 
     # Start listening for incoming connections
     server.listen()
+    loop = aio.get_running_loop()
 
     # Connection handling loop
     while True:
         try:
-            # Try to accept a new client connection
-            client_socket, addr = server.accept()
+            # Wait until a new client connects and accept the connection
+            client_socket, addr = await loop.sock_accept(server)
+            # Send chat messages immediately instead of waiting for Nagle's algorithm
+            client_socket.setsockopt(soc.IPPROTO_TCP, soc.TCP_NODELAY, 1)
             print(f"Connection from {addr} has been established.")
             # Create a new task to handle the client connection
             aio.create_task(handle_client(client_socket, addr))
-        except BlockingIOError:
-            # If no connections are available, yield control to the event loop
-            await aio.sleep(0)
         # pylint: disable=broad-except
         except Exception as e:
             # Handle any other exceptions that may occur
@@ -178,4 +575,8 @@ async def main() -> None:
             break
 
 if __name__ == "__main__":
+    # The default Proactor event loop on Windows has no add_writer,
+    # which defer_write needs to finish sending to a full socket
+    if sys.platform == "win32":
+        aio.set_event_loop_policy(aio.WindowsSelectorEventLoopPolicy())
     aio.run(main())